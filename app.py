@@ -1,9 +1,9 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
-import datetime
-import random
+import functools
 import re
+import sys
+from dataclasses import dataclass
 
 EXAMPLE = """#[account]
 pub struct MyData {
@@ -41,7 +41,8 @@ RULES_STR = """
 | f32        | 4              | serialization will fail for NaN                                   |
 | f64        | 8              | serialization will fail for NaN                                   |
 """
-DEFAULT_SIZE_MAP = {
+# keys are interned so lookups on interned type names are pointer compares
+DEFAULT_SIZE_MAP = {sys.intern(k): v for k, v in {
         'bool': 1,
         'u8': 1, 'i8': 1,
         'u16': 2, 'i16': 2,
@@ -51,29 +52,74 @@ DEFAULT_SIZE_MAP = {
         'pubkey': 32,
         'f32': 4,
         'f64': 8
-    }
+    }.items()}
+# hashable form of the size map so it can be part of a cache key
+DEFAULT_SIZE_ITEMS = tuple(DEFAULT_SIZE_MAP.items())
 
 DEFAULT_VEC = 10
 DEFAULT_STR = 1
+
+_VARIANT_TOKEN_RE = re.compile(r'[{},]')
+_SECTION_RE = re.compile(r'(pub struct|pub enum|impl)', re.IGNORECASE)
+_STRUCT_NAME_RE = re.compile(r'(?:^|\n)\s*pub\s+struct\s+(\w+)\s*\{', re.IGNORECASE)
+# the type of a field, dispatching on which group is set
+_TYPE_RE = re.compile(
+    r'(?P<type>Vec<(?P<vec>[^>]+)>'
+    r'|Option<(?P<opt>[^>]+)>'
+    r'|\[(?P<arr_t>[^;]+);\s*(?P<arr_n>\d+)\s*\]'
+    r'|(?P<scalar>[A-Za-z_]\w*))',
+    re.IGNORECASE,
+)
+# one match per struct field line; the type runs to the end of the line (up to a
+# trailing comma and // comment) and is parsed by _parse_field_type, which
+# reports types it can't handle
+_LOOSE_FIELD_RE = re.compile(
+    r'^[ \t]*(?:#\[[^\]\n]*\][ \t]*)*(?P<name>(?:pub(?:\([^)\n]*\))?[ \t]+)?\w+)[ \t]*:[ \t]*'
+    r'(?P<type>[^\n]+?)[ \t]*[,;]?[ \t]*(?://[^\n]*)?\r?$',
+    re.IGNORECASE | re.MULTILINE,
+)
+
 # Helper function to split variants correctly
 def split_variants(text):
     variants = []
     depth = 0
     start = 0
 
-    for i, c in enumerate(text):
+    # only visit the structural characters instead of every character
+    for m in _VARIANT_TOKEN_RE.finditer(text):
+        c = m.group(0)
         if c == '{':
             depth += 1
         elif c == '}':
             depth -= 1
-        elif c == ',' and depth == 0:
-            variants.append(text[start:i].strip())
-            start = i + 1
+        elif depth == 0:
+            variants.append(text[start:m.start()].strip())
+            start = m.end()
 
     # Append last item
     variants.append(text[start:].strip())
 
     return variants
+
+# Helper function to split an enum section into its name and the body between
+# the outer braces (depth-aware, so struct-like variants don't end it early)
+def split_enum(text):
+    open_at = text.index('{')
+    close_at = len(text)
+    depth = 0
+
+    for m in _VARIANT_TOKEN_RE.finditer(text, open_at):
+        c = m.group(0)
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                close_at = m.start()
+                break
+
+    return text[:open_at], text[open_at + 1:close_at]
+
 class WarningContainer:
     def warning(self, message):
         print("Warning: " + message)
@@ -81,133 +127,149 @@ class WarningContainer:
     def error(self, message):
         print("Error: " + message)
 
-def calculate_struct_size(text, warning_cont, size_map=DEFAULT_SIZE_MAP, session=None):
+@dataclass(slots=True, frozen=True)
+class ParseResult:
+    size: int
+    calc_strs: tuple  # calc string per field
+    comments: tuple  # (size, name, type) per field
+    enum_sizes: tuple  # (enum name, (size, calc str)) per enum
+    messages: tuple  # (level, message) for the warning container
+    sizes: tuple  # size per field
+
+# Replay a result's warnings/errors onto a container (st container or WarningContainer)
+def show_messages(res, warning_cont):
+    for level, message in res.messages:
+        getattr(warning_cont, level)(message)
+
+# Struct definitions repeat the same few types, so the per-type work is memoized.
+# (numba would not help here: it can't compile this kind of string processing)
+@functools.lru_cache(maxsize=1024)
+def _parse_field_type(type_str, vec_size, str_size, lookup_key):
+    # returns (size, calc str, messages), size is None for an unknown type
+    lookup = dict(lookup_key)
+    messages = []
+    field = _TYPE_RE.fullmatch(type_str)
+    if field is None:
+        return None, None, (('error', 'no type: "' +  type_str + '" in byte size map'),)
+    tl = type_str.lower()
+
+    def safe_get_size(base_type):
+        entry = lookup.get(sys.intern(base_type))
+        if entry is None:
+            messages.append(('error', 'ERROR: no type "`' +  base_type + '`" in map (for "`'+type_str+'`")'))
+            return 0
+        return entry[0]
+
+    # Check for special types
+    if field['vec']:
+        messages.append(('warning', f'spotted `Vec`, assuming length {vec_size}'))
+        base_type = field['vec'].strip().lower()
+        this_size = 4 + safe_get_size(base_type) * vec_size
+        calc_str = "4 + {} * {}".format(base_type, vec_size)
+    elif field['opt']:
+        base_type = field['opt'].strip().lower()
+        this_size = 1 + safe_get_size(base_type)
+        calc_str = "1 + {}".format(base_type)
+    elif field['arr_t']:
+        base_type = field['arr_t'].strip().lower()
+        amount = int(field['arr_n'])
+        this_size = safe_get_size(base_type) * amount
+        calc_str = "{} * {}".format(base_type, amount)
+    elif tl == "string":
+        this_size = 4 + str_size
+        calc_str = f"4 + {str_size}"
+    else:
+        entry = lookup.get(sys.intern(tl))
+        if entry is None:
+            messages.append(('error', 'no type: "' +  type_str + '" in byte size map'))
+            return None, None, tuple(messages)
+        this_size, calc_str = entry
+
+    return this_size, calc_str, tuple(messages)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def calculate_struct_size(text, vec_size=DEFAULT_VEC, str_size=DEFAULT_STR, size_items=DEFAULT_SIZE_ITEMS):
+    # pure so it can be cached: warnings/errors are returned in the result and
+    # replayed by the caller onto a container
+    size_map = dict(size_items)
+    messages = []
     enum_sizes = {}
-    struct_size = 0
-    struct_calc_strs = ""
-    comments_strs = []
-
-    # Split the input text into different sections and ignore the 'impl' section
-    sections = re.split(r'(pub struct|pub enum|impl)', text, flags=re.IGNORECASE)
+    sizes = []  # size of each field, summed once at the end
+    struct_calc_strs = []
+    comments_strs = []  # (size, name, type) per field, formatted by the caller
+
+    # Split the input text into (identifier, body) sections
+    matches = list(_SECTION_RE.finditer(text))
+    ends = [m.start() for m in matches[1:]] + [len(text)]
+    sections = [(m.group(1).lower(), text[m.end():end]) for m, end in zip(matches, ends)]
+
+    # Enums are parsed first so structs can refer to them, 'impl' sections are ignored
+    for section in [body for kind, body in sections if kind == 'pub enum']:
+        # names and types are case-insensitive, lowercase the whole body once
+        section = section.lower()
+        enum_name, enum_body = split_enum(section)
+        enum_name = enum_name.strip()
+
+        enum_variants = split_variants(enum_body.strip())
         
-    # Pair each identifier with its corresponding section
-    sections = list(zip(sections[1::2], sections[2::2]))
-
-    # Sort sections so 'pub enum' comes first
-    sections.sort(key=lambda x: {'pub enum': 1, 'pub struct': 2, 'impl': 3}[x[0].lower()])
-
-
-
-
-    for identifier, section in sections:
-        section = identifier.lower() + section
-        if 'impl' in section:
-            continue  # Ignore 'impl' section
-
-        # Parse enums and store their sizes
-        if 'pub enum' in section:
-            enum_name, enum_body = re.search(r'pub enum (.*?) {([^}]*)}', section, re.DOTALL).groups()
-            enum_name = enum_name.strip()
+        enum_size = 1  # Minimum size of an enum is 1 for the discriminant
+        best_variant_types = None  # field types of the largest variant
+
+        for variant in enum_variants:
+            variant = variant.strip()
+            if '{' in variant:
+                variant_name, variant_fields = variant.split('{', 1)
+                variant_fields = variant_fields.rsplit('}', 1)[0].split(',')
+
+                variant_size = 0
+                variant_calc_str = []
+                for field in variant_fields:
+                    field_name, field_type = field.split(':')
+                    field_type = field_type.strip()
+                    variant_size += size_map[field_type]
+                    variant_calc_str.append(field_type)
+
+                if 1 + variant_size > enum_size:
+                    enum_size = 1 + variant_size
+                    best_variant_types = variant_calc_str
+
+        # 1 for the discriminant
+        enum_calc_str = "1 + " + " + ".join(best_variant_types) if best_variant_types else "1"
+        enum_sizes[sys.intern(enum_name)] = (enum_size, enum_calc_str)
+
+    # type name -> (size, calc str), enums shadow builtin types
+    lookup = {key: (value, key) for key, value in size_map.items()}
+    lookup.update(enum_sizes)
+
+    # hashed once, so probing the field cache with it stays cheap
+    lookup_key = frozenset(lookup.items())
+
+    # Parse the structs and find all lines that define a variable
+    for section in [body for kind, body in sections if kind == 'pub struct']:
+        struct_calc_strs = []
+
+        for field in _LOOSE_FIELD_RE.finditer(section):
+            name, type_str = field['name'], field['type']
+            this_size, calc_str, field_messages = _parse_field_type(type_str, vec_size, str_size, lookup_key)
+            messages.extend(field_messages)
+            if this_size is None:
+                continue
+            sizes.append(this_size)
+            struct_calc_strs.append(calc_str)
+            comments_strs.append((this_size, name, type_str))
+
+    return ParseResult(
+        size=sum(sizes),
+        calc_strs=tuple(struct_calc_strs),
+        comments=tuple(comments_strs),
+        enum_sizes=tuple(enum_sizes.items()),
+        messages=tuple(messages),
+        sizes=tuple(sizes),
+    )
 
-            enum_variants = split_variants(enum_body.strip())
-            
-            enum_size = 1  # Minimum size of an enum is 1 for the discriminant
-            enum_calc_str = "1"  # 1 for the discriminant
-
-            for variant in enum_variants:
-                variant = variant.strip()
-                if '{' in variant:
-                    variant_name, variant_fields = variant.split('{', 1)
-                    variant_fields = variant_fields.rsplit('}', 1)[0].split(',')
-
-                    variant_size = 0
-                    variant_calc_str = []
-                    for field in variant_fields:
-                        field_name, field_type = field.split(':')
-                        field_type = field_type.strip()
-                        variant_size += size_map[field_type.lower()]
-                        variant_calc_str.append(field_type.lower())
-
-                    enum_size = max(enum_size, 1 + variant_size)
-                    enum_calc_str = f"1 + {' + '.join(variant_calc_str)}"
-
-            enum_sizes[enum_name.lower()] = (enum_size, enum_calc_str)
-                
-        # Parse the struct and find all lines that define a variable
-        elif 'pub struct' in section:
-
-            def safe_get_size(base_type):
-                this_size_0 = 0
-                if base_type.lower() in size_map:
-                    this_size_0 = size_map.get(base_type.lower(), 0)
-                elif base_type.lower() in enum_sizes:
-                    this_size_0 = enum_sizes[base_type.lower()][0]
-                else:
-                    warning_cont.error('ERROR: no type "`' +  base_type + '`" in map (for "`'+str(line)+'`")')
-                return this_size_0
-            
-            struct_calc_strs = []
-
-            lines = section.split("\n")
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith("//"):
-                    continue
-                
-                # Remove comments, if any
-                line = line.split("//")[0]
-                
-                # Parse type and variable name
-                parts = line.split(":")
-                if len(parts) != 2:
-                    continue
-                type_str = parts[1].strip().rstrip(",").rstrip(";").strip()
-
-                # Check for special types
-                if type_str.lower().startswith("vec<"):
-                    vec_size = st.session_state.get('vec_size', DEFAULT_VEC)
-                    warning_cont.warning(f'spotted `Vec`, assuming length {vec_size}')
-                    base_type = re.search(r'vec<(.*?)>', type_str, re.IGNORECASE).group(1)
-                    this_size = 4 + size_map[base_type.lower()] * vec_size
-                    struct_size += this_size
-                    struct_calc_strs.append("4 + {} * {}".format(base_type.lower(), vec_size))
-                    comments_strs.append(f"+ {this_size} // {parts[0]}: {type_str}")
-                elif type_str.lower().startswith("option<"):
-                    base_type = re.search(r'option<(.*?)>', type_str, re.IGNORECASE).group(1)
-                    this_size_0 = safe_get_size(base_type)
-                    this_size = 1 + this_size_0
-                    struct_size += this_size
-                    struct_calc_strs.append("1 + {}".format(base_type.lower()))
-                    comments_strs.append(f"+ {this_size} // {parts[0]}: {type_str}")
-                elif type_str.startswith("string"):
-                    this_size = 4 + DEFAULT_STR
-                    struct_size += this_size
-                    struct_calc_strs.append(f"4 + {DEFAULT_STR}")
-                    comments_strs.append(f"+ {this_size} // {parts[0]}: {type_str}")
-                elif type_str.startswith("[") and type_str.endswith("]"):
-                    match = re.search(r'\[(.*?);(.*?)\]', type_str)
-                    base_type = match.group(1)
-                    amount = int(match.group(2))
-                    this_size_0 = safe_get_size(base_type)
-                    this_size = this_size_0  * amount
-                    struct_size += this_size
-                    struct_calc_strs.append("{} * {}".format(base_type.lower(), amount))
-                    comments_strs.append(f"+ {this_size} // {parts[0]}: {type_str}")
-                elif type_str.lower() in enum_sizes:
-                    enum_size, enum_calc_str = enum_sizes[type_str.lower()]
-                    struct_size += enum_size
-                    struct_calc_strs.append(enum_calc_str)
-                    comments_strs.append(f"+ {enum_size} // {parts[0]}: {type_str}")
-                elif type_str.lower() in size_map:
-                    struct_size += size_map[type_str.lower()]
-                    struct_calc_strs.append(type_str.lower())
-                    comments_strs.append(f"+ { size_map[type_str.lower()]} // {parts[0]}: {type_str}")
-                else:
-                    warning_cont.error('no type: "' +  type_str + '" in byte size map')
-
-    size_map.update({key: value[0] for key,value in enum_sizes.items()})
-    
-    return struct_size, struct_calc_strs, comments_strs, size_map
+@st.cache_data
+def _assumps_df():
+    return pd.DataFrame([('Vec', DEFAULT_VEC), ('String', DEFAULT_STR)], columns=['Custom Types', 'Space in bytes'])
 
 def main():
     st.set_page_config(
@@ -219,8 +281,10 @@ def main():
     st.caption("Sail through byte measurements effortlessly")
     tabs = st.tabs(['calculate size', 'byte rules'])
     
-    st.session_state['code_input'] = EXAMPLE
-    st.session_state['code_output_mode'] = False
+    # seed defaults only; the text area owns 'code_input' through its key, so
+    # edits survive reruns
+    st.session_state.setdefault('code_input', EXAMPLE)
+    st.session_state.setdefault('code_output_mode', False)
     # st.sidebar.header('byte size map')
 
     # man_letters = st.sidebar.text_input('manual override letters:', '')
@@ -238,15 +302,23 @@ def main():
         if b1.button('Example'):
             st.session_state.clear()
             st.session_state['code_input'] = EXAMPLE
-        struct = c1.text_area("code input:", st.session_state.get('code_input', ''), height=400)
+        # only re-parse on submit instead of on every edit of the text area
+        with c1.form('calc'):
+            struct = st.text_area("code input:", key='code_input', height=400)
+            submitted = st.form_submit_button('Compute')
 
-        st.session_state['code_input'] = struct
         code_cont = c2.container()
         warn_cont = c2.container()
-        size, comments, comments_strs, size_map = calculate_struct_size(struct, warn_cont, DEFAULT_SIZE_MAP, st.session_state)
-        noms = [x.split('{')[0].strip() for x in struct.split('struct') if '{' in x]
-        noms = [nom for nom in noms if '\npub' not in nom]
-        the_nom = ''.join(noms)
+        if submitted or 'last_result' not in st.session_state:
+            st.session_state['last_result'] = calculate_struct_size(
+                struct,
+                st.session_state.get('vec_size', DEFAULT_VEC),
+                st.session_state.get('str_size', DEFAULT_STR),
+            )
+        res = st.session_state['last_result']
+        size, comments, comments_strs = res.size, res.calc_strs, res.comments
+        show_messages(res, warn_cont)
+        the_nom = ''.join(_STRUCT_NAME_RE.findall(struct))
         if size != 0 and st.session_state.get('code_output_mode'):
             # c2.markdown(' \n\n')
             code_cont.markdown(f'**`{the_nom}`** : **`{size}`** bytes')
@@ -254,24 +326,25 @@ def main():
             code_cont.markdown(' \n\n')
             code_cont.markdown(' \n\n')
 
-        # st.sidebar.json(size_map, expanded=True)
+        # st.sidebar.json({**DEFAULT_SIZE_MAP, **{key: value[0] for key, value in res.enum_sizes}}, expanded=True)
         # st.sidebar.write(comments_strs)
         # st.sidebar.write(st.session_state)
 
         if struct and size>0:
-            code_res = ""
+            comment_lines = [f"+ {s} // {n}: {t}" for s, n, t in comments_strs]
+            code_parts = []
             if st.session_state.get('code_output_mode', False):
-                code_res += struct
+                code_parts.append(struct)
             
-            code_res += """\n
+            code_parts.append("""\n
 impl """+the_nom+""" {
     pub const MAX_SIZE: usize = """+str(size)+""";
-    // """ +'\n    // '.join(comments_strs+[';'])+"""
+    // """ +'\n    // '.join(comment_lines+[';'])+"""
 }
-        """
+        """)
             
             if st.session_state.get('code_output_mode', False):
-                code_res += """
+                code_parts.append("""
     #[derive(Accounts)]
     pub struct Initialize"""+the_nom+"""<'info> {
         // Note that we have to add 8 to the space for the internal anchor
@@ -279,7 +352,8 @@ impl """+the_nom+""" {
         pub acc: Account<'info, """+the_nom+""">,
         pub signer: Signer<'info>,
         pub system_program: Program<'info, System>
-    }"""
+    }""")
+            code_res = "".join(code_parts)
             code_cont.code(code_res, language="rust",)
         elif struct.strip()!='' and size==0:
             code_cont.code('// cannot detect account size', language="rust",)
@@ -301,26 +375,27 @@ impl """+the_nom+""" {
         st.markdown('Call to action from [this Superteam Request](https://earn.superteam.fun/listings/bounties/build-an-anchor-space-calculator/)')
         st.markdown('This [reference](https://www.anchor-lang.com/docs/space) tells you how much space you should allocate for an account.')
         # st.write(RULES_STR)
-        df = pd.DataFrame(DEFAULT_SIZE_MAP, index=['Space in bytes']).T
-        df.index.name = 'Types'
         d1, d2 = st.columns(2)
-        d1.dataframe(df, use_container_width=True)   
-        assumps_df = pd.DataFrame([('Vec', 10), ('String', 1)], columns=['Custom Types', 'Space in bytes'])
-        edited_df = d2.experimental_data_editor(assumps_df,
+        # the type names are the row labels
+        d1.table({'Space in bytes': DEFAULT_SIZE_MAP})
+        edited_df = d2.data_editor(_assumps_df(),
                                     # height=260,
                                     num_rows="dynamic", disabled=False, use_container_width=True) 
         # st.write(edited_df)
         # st.write(edited_df.set_index('Custom Types').loc['Vec', 'Space in bytes'])
         t1 = edited_df.set_index('Custom Types').loc['Vec', 'Space in bytes']
         t2 = edited_df.set_index('Custom Types').loc['String', 'Space in bytes']
-        cur_str = st.session_state.get('str_size')
-        cur_vec = st.session_state.get('vec_size')                                        
-        if (t1 != DEFAULT_VEC and cur_vec is None) or (t1 != st.session_state.get('vec_size', None) and cur_vec is not None):
+        # rerun once, even if both assumptions changed
+        changed = False
+        if t1 != st.session_state.get('vec_size', DEFAULT_VEC):
             st.session_state['vec_size'] = t1
-            st.experimental_rerun()
-        if (t2 != DEFAULT_STR and cur_str is None) or (t2 != st.session_state.get('str_size', None) and cur_str is not None):
+            changed = True
+        if t2 != st.session_state.get('str_size', DEFAULT_STR):
             st.session_state['str_size'] = t2
-            st.experimental_rerun()
+            changed = True
+        if changed:
+            st.session_state.pop('last_result', None)
+            st.rerun()
 
 
 